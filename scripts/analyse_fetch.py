@@ -1,94 +1,168 @@
-import collections
-import json
+from concurrent.futures import ProcessPoolExecutor
 import os
 
+import matplotlib
+matplotlib.use('Agg')  # headless, plots are only written to file
 import matplotlib.pyplot as plt
-import pandas as pd
+import numpy as np
+import polars as pl
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from pandas.io.json import ujson_loads as json_loads
+
+# fetch workers write timestamps with datetime.isoformat(), %.f also accepts a missing fraction
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S%.f'
+
+# known exception messages are grouped under a short label, anything else is shown as is
+EXCEPTION_TYPES = {
+    'workers died while running it': 'Worker died',
+    'find normal JSON section': 'No JSON',
+}
+
+def load_results(dir_path):
+    # the parsed columns needed for plotting are cached next to the json,
+    # so later runs can skip parsing the json entirely
+    json_path = os.path.join(dir_path, 'results.json')
+    cache_path = os.path.join(dir_path, 'results.parquet')
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(json_path):
+        return pl.read_parquet(cache_path)
+
+    with open(json_path, 'rb') as f:
+        results = json_loads(f.read())
+
+    # older result files stored the return directly in 'result', with the times at the top level
+    nested_result = isinstance(results[0]['result'], dict)
+
+    exception_lists = []
+    pre_times = []
+    post_times = []
+    has_returns = []
+    video_ids = []
+    for r in results:
+        exception_lists.append(r['exceptions'])
+        res = r.get('result')
+        if nested_result:
+            ret = res.get('return')
+            pre_times.append(res.get('pre_time'))
+            post_times.append(res.get('post_time'))
+        else:
+            ret = res
+            pre_times.append(r['pre_time'])
+            post_times.append(r['post_time'])
+        has_returns.append(ret is not None)
+
+        if res and 'id' in res:
+            video_ids.append(int(res['id']))
+        elif res and ret and 'id' in ret:
+            video_ids.append(int(ret['id']))
+        else:
+            video_ids.append(None)
+
+    df = pl.DataFrame({
+        'exceptions': exception_lists,
+        'pre_time': pre_times,
+        'post_time': post_times,
+        'has_return': has_returns,
+        'video_id': pl.Series(video_ids, dtype=pl.UInt64),
+    }).with_columns(
+        pl.col('pre_time').cast(pl.String).str.to_datetime(TIME_FORMAT),
+        pl.col('post_time').cast(pl.String).str.to_datetime(TIME_FORMAT)
+    )
+    df.write_parquet(cache_path, compression='zstd')
+    return df
 
 def plot_results(dir_path):
-    with open(os.path.join(dir_path, 'parameters.json')) as f:
-        params = json.load(f)
-    with open(os.path.join(dir_path, 'results.json')) as f:
-        results = json.load(f)
-
-    df = pd.DataFrame(results)
-    returns = [r['result'] for r in results]
-    if not isinstance(returns[0], dict):
-        returns = [{'pre_time': r['pre_time'], 'post_time': r['post_time'], 'return': r['result']} for r in results]
-    result_df = pd.DataFrame(returns)
-    result_df['pre_time'] = pd.to_datetime(result_df['pre_time'], format='mixed')
-    result_df['post_time'] = pd.to_datetime(result_df['post_time'], format='mixed')
-    
-    df['num_exceptions'] = df['exceptions'].apply(len)
-    result_timeline_df = result_df[['pre_time', 'return']].dropna().groupby(pd.Grouper(key='pre_time', freq='1s')).count()
+    with open(os.path.join(dir_path, 'parameters.json'), 'rb') as f:
+        params = json_loads(f.read())
+    df = load_results(dir_path)
+
+    result_timeline_df = df.filter(pl.col('pre_time').is_not_null() & pl.col('has_return'))\
+        .sort('pre_time')\
+        .group_by_dynamic('pre_time', every='1s')\
+        .agg(pl.len())\
+        .upsample('pre_time', every='1s')\
+        .fill_null(0)
     
-    fig, axes = plt.subplots(nrows=1, ncols=3, figsize=(12, 5))
-    axes[0].bar(df['num_exceptions'].value_counts().index, df['num_exceptions'].value_counts())
+    fig, axes = plt.subplots(nrows=1, ncols=3, figsize=(12, 5), constrained_layout=True)
+    num_exceptions_counts = df['exceptions'].list.len().alias('num_exceptions').value_counts()
+    axes[0].bar(num_exceptions_counts['num_exceptions'].to_numpy(), num_exceptions_counts['count'].to_numpy())
     axes[0].set_yscale('log')
     axes[0].set_xlabel('Number of exceptions')
     axes[0].set_ylabel('Number of occurrences')
     axes[0].set_title('Number of exceptions')
-    axes[1].plot(result_timeline_df.index, result_timeline_df, label='Returns')
+    axes[1].plot(result_timeline_df['pre_time'].to_numpy(), result_timeline_df['len'].to_numpy(), label='Returns')
     axes[1].set_xlabel('Time')
     axes[1].set_ylabel('Number of fetches')
     axes[1].set_title('Fetches over time')
 
-    exception_lists = [r['exceptions'] for r in results]
-    exceptions = [e for l in exception_lists for e in l]
-    if len(exceptions) > 0 and isinstance(exceptions[0], dict):
-        exception_df = pd.DataFrame(exceptions)
-        exception_df['pre_time'] = pd.to_datetime(exception_df['pre_time'], format='mixed')
-        exception_df['post_time'] = pd.to_datetime(exception_df['post_time'], format='mixed')
-        exception_timeline_df = exception_df[['pre_time', 'exception']].dropna().groupby(pd.Grouper(key='pre_time', freq='1s')).count()
-        axes[1].plot(exception_timeline_df.index, exception_timeline_df, label='Exceptions')
+    top_exceptions = []
+    if isinstance(df.schema['exceptions'].inner, pl.Struct):
+        # only the exception text and start time are used, so flatten lazily and parse just those
+        exception_df = df.lazy()\
+            .select('exceptions')\
+            .explode('exceptions')\
+            .unnest('exceptions')\
+            .drop_nulls('exception')\
+            .select(
+                pl.col('exception'),
+                pl.col('pre_time').cast(pl.String).str.to_datetime(TIME_FORMAT)
+            )\
+            .collect()
+        exception_timeline_df = exception_df.drop_nulls('pre_time')\
+            .sort('pre_time')\
+            .group_by_dynamic('pre_time', every='1s')\
+            .agg(pl.len())\
+            .upsample('pre_time', every='1s')\
+            .fill_null(0)
+        axes[1].plot(exception_timeline_df['pre_time'].to_numpy(), exception_timeline_df['len'].to_numpy(), label='Exceptions')
         axes[1].legend()
 
-    videos = []
-    for r in results:
-        if 'result' in r and r['result'] and 'id' in r['result']:
-            videos.append(r['result'])
-        elif 'result' in r and r['result'] and 'return' in r['result'] and r['result']['return'] and 'id' in r['result']['return']:
-            videos.append(r['result']['return'])
-    num_videos = len(videos)
+        exception_types = exception_df.select(
+            pl.coalesce(
+                pl.col('exception').str.extract_many(list(EXCEPTION_TYPES)).list.first().replace(EXCEPTION_TYPES),
+                pl.col('exception')
+            ).alias('exception_type')
+        )
+        top_exceptions = exception_types.group_by('exception_type').len().top_k(5, by='len').sort('len', descending=True).rows()
+
+    video_ids = df['video_id'].drop_nulls()
+    num_videos = len(video_ids)
     fargate_spot_usd_per_vcpu_per_hour = 0.013368
     fargate_spot_usd_per_gb_per_hour = 0.0014595
-    num_seconds = (result_df['post_time'].max() - result_df['pre_time'].min()).total_seconds()
+    num_seconds = (df['post_time'].max() - df['pre_time'].min()).total_seconds()
     num_hours = num_seconds / 3600
     num_vcpus = params['worker_cpu'] / 1024
     num_gb = params['worker_mem'] / 1024
     num_workers = params['num_workers']
     cost = num_workers * num_hours * (num_vcpus * fargate_spot_usd_per_vcpu_per_hour + num_gb * fargate_spot_usd_per_gb_per_hour)
     time_span = f"{params['num_time']}{params['time_unit']}"
-    fig.suptitle(f"Time Interval: {time_span}, Number of fetches: {len(results)}, Number of videos: {num_videos}, Estimated Cost: ${cost:.2f}")
-
-    def get_type(ex):
-        ex_txt = ex['exception']
-        if 'workers died while running it' in ex_txt:
-            return 'Worker died'
-        elif 'find normal JSON section' in ex_txt:
-            return 'No JSON'
-        else:
-            return ex_txt
-    exception_types = [get_type(ex) for ex in exceptions if 'exception' in ex]
+    fig.suptitle(f"Time Interval: {time_span}, Number of fetches: {len(df)}, Number of videos: {num_videos}, Estimated Cost: ${cost:.2f}")
 
-    top_exceptions = [[e, count] for e, count in sorted(collections.Counter(exception_types).items(), key=lambda x: x[1], reverse=True)[:5]]
-    axes[2].table(cellText=[ex for ex in top_exceptions], colLabels=['Exception', 'Number'])
+    axes[2].table(cellText=[list(ex) for ex in top_exceptions], colLabels=['Exception', 'Number'])
 
-    fig.savefig(os.path.join(dir_path, 'plot.png'))
+    # low zlib level, encode time matters more than file size here
+    fig.savefig(os.path.join(dir_path, 'plot.png'), pil_kwargs={'compress_level': 1})
     plt.close(fig)
 
     # get the number of unique bits in the ID
-    ids = [r['id'] for r in videos]
-    video_last_bits = [format(int(id), '064b')[41:] for id in ids]
-    print(f"Number of unique bits in the ID: {len(set(video_last_bits))}")
+    # bits 41-63 of the 64 bit ID are the lowest 23 bits
+    ids = video_ids.to_numpy()
+    video_last_bits = ids & np.uint64((1 << 23) - 1)
+    print(f"Number of unique bits in the ID: {np.unique(video_last_bits).size}")
 
 def main():
     this_dir_path = os.path.dirname(os.path.realpath(__file__))
     data_dir_path = os.path.join(this_dir_path, '..', 'data', 'results')
 
-    for root, dirs, files in os.walk(data_dir_path):
-        if 'results.json' in files and 'parameters.json' in files:
-            plot_results(root)
+    result_dir_paths = [
+        root for root, dirs, files in os.walk(data_dir_path)
+        if 'results.json' in files and 'parameters.json' in files
+    ]
+
+    # matplotlib figure state is not thread safe, so plot each directory in its own process
+    with ProcessPoolExecutor() as executor:
+        list(executor.map(plot_results, result_dir_paths))
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,20 @@
+import os
+
+import polars as pl
+
+def convert_parquet_to_zstd(parquet_path):
+    zstd_path = parquet_path.replace('.parquet.gzip', '.parquet.zstd')
+    pl.read_parquet(parquet_path).write_parquet(zstd_path, compression='zstd', compression_level=3)
+    return zstd_path
+
+def main():
+    this_dir_path = os.path.dirname(os.path.realpath(__file__))
+    data_dir_path = os.path.join(this_dir_path, '..', 'data', 'topic_model_videos_1000')
+
+    # zstd decodes much faster than gzip at a similar ratio, so re-encode the datamap inputs once
+    for file_name in ['video_topics.parquet.gzip', 'topic_info.parquet.gzip']:
+        zstd_path = convert_parquet_to_zstd(os.path.join(data_dir_path, file_name))
+        print(f"Wrote {zstd_path}")
+
+if __name__ == '__main__':
+    main()
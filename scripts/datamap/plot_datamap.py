@@ -1,8 +1,9 @@
 import os
 import re
 
-import datamapplot
 import matplotlib as mpl
+mpl.use('Agg')  # headless, set before datamapplot imports pyplot
+import datamapplot
 import numpy as np
 import polars as pl
 from PIL import Image
@@ -10,32 +11,41 @@ from PIL import Image
 def convert_to_image(cols):
     return Image.frombytes(cols['Visual_Aspect_Mode'], tuple(cols['Visual_Aspect_Size']), cols['Visual_Aspect_Bytes'])
 
+def topic_parquet_path(data_dir_path, name):
+    # prefer the zstd copy from convert_parquet_to_zstd.py, falling back to the gzip file topic_model_videos.py writes
+    zstd_path = os.path.join(data_dir_path, f'{name}.parquet.zstd')
+    if os.path.exists(zstd_path):
+        return zstd_path
+    return os.path.join(data_dir_path, f'{name}.parquet.gzip')
+
 def main():
     this_dir_path = os.path.dirname(os.path.realpath(__file__))
     data_dir_path = os.path.join(this_dir_path, '..', 'data', f'topic_model_videos_1000')
 
-    video_df = pl.read_parquet(os.path.join(data_dir_path, 'video_topics.parquet.gzip'))
+    video_df = pl.scan_parquet(topic_parquet_path(data_dir_path, 'video_topics'))\
+        .select(['topic', 'playCount'])\
+        .collect()
 
-    embeddings_2d = np.load(os.path.join(data_dir_path, 'reduced_embeddings.npy'))
+    embeddings_2d = np.load(os.path.join(data_dir_path, 'reduced_embeddings.npy'), mmap_mode='r')
 
-    topic_info_df = pl.read_parquet(os.path.join(data_dir_path, 'topic_info.parquet.gzip'))
+    topic_info_df = pl.scan_parquet(topic_parquet_path(data_dir_path, 'topic_info'))\
+        .select(['Topic', 'Count', 'Name'])\
+        .collect()
     # topic_info_df['Visual_Aspect'] = topic_info_df[['Visual_Aspect_Mode', 'Visual_Aspect_Size', 'Visual_Aspect_Bytes']].apply(convert_to_image, axis=1)
 
-    topic_info_df = topic_info_df.with_columns(pl.col('Name').map_elements(lambda n: ','.join(n.split('_')[1:]), return_dtype=pl.String).alias('Desc'))
+    topic_info_df = topic_info_df.with_columns(pl.col('Name').str.split('_').list.slice(1).list.join(',').alias('Desc'))
 
     top_n_topics = 30
     if top_n_topics:
         topic_info_df = topic_info_df.sort('Count', descending=True).head(top_n_topics)
 
     # Prepare text and names
-    topic_name_mapping = {row['Topic']: row['Desc'] for row in topic_info_df[['Topic', 'Desc']].to_dicts()}
+    # every topic outside the top n is unlabelled
+    topic_desc_mapping = dict(zip(topic_info_df['Topic'].to_list(), topic_info_df['Desc'].to_list()))
+    all_topics = video_df['topic'].unique().to_list()
+    topic_name_mapping = {topic_num: topic_desc_mapping.get(topic_num, "Unlabelled") for topic_num in all_topics}
     topic_name_mapping[-1] = "Unlabelled"
 
-    if top_n_topics:
-        for topic_num in topic_info_df['Topic'].to_list():
-            if topic_num not in topic_name_mapping:
-                topic_name_mapping[topic_num] = "Unlabelled"
-
     # If a set of topics is chosen, set everything else to "Unlabelled"
     chosen_topics = None
     if chosen_topics:
@@ -45,7 +55,10 @@ def main():
                 topic_name_mapping[topic_num] = "Unlabelled"
 
     # Map in topic names and plot
-    named_topic_per_doc = video_df['topic'].replace_strict(topic_name_mapping, default='Unlabelled').to_list()
+    # look up each distinct topic once and broadcast the names back with the inverse index
+    unique_topics, topic_idx = np.unique(video_df['topic'].to_numpy(), return_inverse=True)
+    unique_topic_names = np.array([topic_name_mapping.get(t, 'Unlabelled') for t in unique_topics.tolist()], dtype=object)
+    named_topic_per_doc = unique_topic_names[topic_idx]
 
     # TODO dot size determined by view count
 
@@ -66,7 +79,8 @@ def main():
 
     figs_dir_path = os.path.join(this_dir_path, '..', 'figs')
     os.makedirs(figs_dir_path, exist_ok=True)
-    fig.savefig(os.path.join(figs_dir_path, 'datamapplot.png'), bbox_inches='tight')
+    # the png is already a raster, so the cost is in encoding it, and a low zlib level is much faster for a slightly bigger file
+    fig.savefig(os.path.join(figs_dir_path, 'datamapplot.png'), bbox_inches='tight', pil_kwargs={'compress_level': 1})
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
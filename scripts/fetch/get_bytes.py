@@ -3,15 +3,31 @@ import datetime
 import json
 import os
 import subprocess
+from types import MappingProxyType
 
 import dotenv
 import httpx
 import pandas as pd
 import tqdm
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 
-from get_random_sample import get_headers, ProcessVideo
+from get_random_sample import HEADERS, process_video
 from map_funcs import async_amap
 
+# static, so built once and shared read-only by every video bytes request
+BYTES_HEADERS = MappingProxyType({
+    'sec-ch-ua': '"HeadlessChrome";v="123", "Not:A-Brand";v="8", "Chromium";v="123"', 
+    'referer': 'https://www.tiktok.com/', 
+    'accept-encoding': 'identity;q=1, *;q=0', 
+    'sec-ch-ua-mobile': '?0', 
+    'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.6312.4 Safari/537.36', 
+    'range': 'bytes=0-', 
+    'sec-ch-ua-platform': '"Windows"'
+})
+
 def read_result_path(result_path):
     with open(result_path, 'r') as f:
         try:
@@ -47,7 +63,6 @@ async def fetch_video_data(video_data):
         try:
             video_id = video_data['id']
             url = f"https://www.tiktok.com/@{video_data['author']['uniqueId']}/video/{video_id}"
-            headers = get_headers()
 
             id_bits = format(int(video_id), '064b')
             timestamp_bits = id_bits[:32]
@@ -56,24 +71,11 @@ async def fetch_video_data(video_data):
             timestamp_dir = os.path.join(bytes_dir_path, str(timestamp))
             
             async with httpx.AsyncClient() as client:
-                info_res = await client.get(url, headers=headers)
+                info_res = await client.get(url, headers=HEADERS)
                 if info_res.status_code != 200:
                     return None, None
-                text_chunk = info_res.text
-                video_processor = ProcessVideo()
-                do = video_processor.process_chunk(text_chunk)
-
-                bytes_headers = {
-                    'sec-ch-ua': '"HeadlessChrome";v="123", "Not:A-Brand";v="8", "Chromium";v="123"', 
-                    'referer': 'https://www.tiktok.com/', 
-                    'accept-encoding': 'identity;q=1, *;q=0', 
-                    'sec-ch-ua-mobile': '?0', 
-                    'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/123.0.6312.4 Safari/537.36', 
-                    'range': 'bytes=0-', 
-                    'sec-ch-ua-platform': '"Windows"'
-                }
-
-                video_d = video_processor.process_response()
+                # the page is already fully read, so the JSON is sliced straight out of the response bytes
+                video_d = process_video(info_res.content)
 
                 timestamp = datetime.datetime.now().timestamp()
 
@@ -84,7 +86,7 @@ async def fetch_video_data(video_data):
                     return video_d, timestamp
 
                 cookies = {c: info_res.cookies[c] for c in info_res.cookies}
-                bytes_res = await client.get(video_d['video']['downloadAddr'], headers=bytes_headers, cookies=cookies)
+                bytes_res = await client.get(video_d['video']['downloadAddr'], headers=BYTES_HEADERS, cookies=cookies)
                 if 200 <= bytes_res.status_code >= 300:
                     return video_d, timestamp
                 content = bytes_res.content
@@ -163,4 +165,7 @@ async def main():
             continue
 
 if __name__ == "__main__":
+    if uvloop is not None:
+        uvloop.install()
     asyncio.run(main())
+
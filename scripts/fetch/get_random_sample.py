@@ -3,14 +3,18 @@ import collections
 from concurrent.futures import ThreadPoolExecutor
 import configparser
 import datetime
+import functools
 import io
 import itertools
 import json
 import os
+import pickle
 import re
 import time
 import traceback
 import subprocess
+import threading
+from types import MappingProxyType
 
 import asyncssh
 import brotli
@@ -19,8 +23,21 @@ from dask.distributed import Client as DaskClient
 from dask.distributed import LocalCluster as DaskLocalCluster
 from dask.distributed import as_completed as dask_as_completed
 import dotenv
+import httpx
 import hydra
 import numpy as np
+try:
+    import numba
+except ImportError:
+    numba = None
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 import polars as pl
 import pycurl
 import randmac
@@ -30,7 +47,7 @@ from tqdm import tqdm
 from tqdm.asyncio import tqdm as atqdm
 
 from dask_extensions import UnreliableSSHCluster
-from map_funcs import _amap
+from map_funcs import async_amap
 from setup_pis import change_mac_addresses, get_hosts_with_retries, start_wifi_connections, restart_down_slurm_nodes, stop_stale_workers
 
 def ensure_wifi_connection(wlan_username, wlan_password, force_start=False, password=None):
@@ -147,18 +164,60 @@ def change_mac_address(wlan_username, wlan_password, password=None):
     r = subprocess.run(prepend + ["nmcli", "connection", "up", "eduroam"], capture_output=True)
     
 
-def thread_map(*args, function=None, num_workers=10):
-    assert function is not None, "function must be provided"
-    with ThreadPoolExecutor(max_workers=num_workers) as executor:
-        return list(executor.map(function, *args))
+class ThreadLocalCache:
+    # values are made once per thread and key, and kept for the life of that thread.
+    # the functions shipped to workers reference these, and as the script is run as __main__ they are pickled by value,
+    # so a pickled cache comes back empty rather than trying to pickle the thread local
+    def __init__(self):
+        self.local = threading.local()
 
+    def __getstate__(self):
+        return {}
 
-def wait_until(condition, interval=0.1, timeout=1, *args):
-    start = time.time()
-    while not condition(*args) and time.time() - start < timeout:
-        time.sleep(interval)
-    if time.time() - start >= timeout:
-        raise TimeoutError("Timed out waiting for condition")
+    def __setstate__(self, state):
+        self.local = threading.local()
+
+    def get(self, key, factory):
+        if not hasattr(self.local, 'values'):
+            self.local.values = {}
+        if key not in self.local.values:
+            self.local.values[key] = factory()
+        return self.local.values[key]
+
+# long-lived thread pools for each calling thread, so each batch doesn't have to start new threads
+_thread_map_executors = ThreadLocalCache()
+
+def thread_map(*args, function=None, num_workers=10, executor=None):
+    assert function is not None, "function must be provided"
+    if executor is None:
+        executor = _thread_map_executors.get(num_workers, lambda: ThreadPoolExecutor(max_workers=num_workers))
+    return list(executor.map(function, *args))
+
+
+async def wait_until(condition, interval=0.5, timeout=1, *args):
+    # condition is a coroutine function, and the wait sleeps on the event loop so other tasks keep running
+    start = time.monotonic()
+    while not await condition(*args):
+        if time.monotonic() - start >= timeout:
+            raise TimeoutError("Timed out waiting for condition")
+        await asyncio.sleep(interval)
+
+async def no_workers(client):
+    return len((await client.scheduler.identity())['workers']) == 0
+
+async def refresh_fargate_workers(cluster, client, function, num_workers):
+    # recreate the workers to get new IPs, returning the function scattered to the new workers
+    cluster.scale(0)
+    # retire the old workers directly, which returns once they're closed,
+    # so the poll below normally succeeds on its first check
+    old_workers = list((await client.scheduler.identity())['workers'])
+    if old_workers:
+        await client.retire_workers(workers=old_workers, close_workers=True)
+    await wait_until(no_workers, 0.5, 120, client)
+    cluster.adapt(minimum=1, maximum=num_workers)
+    await client.wait_for_workers(1, timeout=120)
+    # the scattered function went down with the old workers
+    return await client.scatter(function, broadcast=True, hash=False)
 
 
 class ClusterManager:
@@ -207,6 +266,20 @@ class ClusterManager:
         return [dict(username=un, password=raspi_password, known_hosts=None) for un in usernames]
 
 
+@functools.lru_cache(maxsize=1)
+def get_fargate_env():
+    # read once, rather than every time the cluster is recreated
+    return {
+        'aws_access_key_id': os.environ['AWS_ACCESS_KEY'],
+        'aws_secret_access_key': os.environ['AWS_SECRET_KEY'],
+        'cluster_arn': os.environ['ECS_CLUSTER_ARN'],
+        'scheduler_task_definition_arn': os.environ['SCHEDULER_TASK_DEFINITION_ARN'],
+        'worker_task_definition_arn': os.environ['WORKER_TASK_DEFINITION_ARN'],
+        'execution_role_arn': os.environ['EXECUTION_ROLE_ARN'],
+        'task_role_arn': os.environ['TASK_ROLE_ARN'],
+        'security_groups': [os.environ['SECURITY_GROUP_ID']],
+    }
+
 class DaskCluster:
     def __init__(self, cluster_type, manager, worker_nthreads=1, worker_cpu=256, worker_mem=512):
         self.cluster_type = cluster_type
@@ -223,18 +296,11 @@ class DaskCluster:
             self.cluster = DaskFargateCluster(
                 fargate_spot=True,
                 image="daskdev/dask:latest-py3.10", 
-                environment={'EXTRA_PIP_PACKAGES': 'httpx==0.27.0 brotlipy==0.7.0 tqdm==4.66.2 lz4==4.3.3 msgpack==1.0.8 toolz==0.12.1'},
+                environment={'EXTRA_PIP_PACKAGES': 'httpx==0.27.0 brotlipy==0.7.0 orjson==3.10.3 tqdm==4.66.2 lz4==4.3.3 msgpack==1.0.8 toolz==0.12.1'},
                 worker_cpu=self.worker_cpu,
                 worker_nthreads=self.worker_nthreads,
                 worker_mem=self.worker_mem,
-                aws_access_key_id=os.environ['AWS_ACCESS_KEY'],
-                aws_secret_access_key=os.environ['AWS_SECRET_KEY'],
-                cluster_arn=os.environ['ECS_CLUSTER_ARN'],
-                scheduler_task_definition_arn=os.environ['SCHEDULER_TASK_DEFINITION_ARN'],
-                worker_task_definition_arn=os.environ['WORKER_TASK_DEFINITION_ARN'],
-                execution_role_arn=os.environ['EXECUTION_ROLE_ARN'],
-                task_role_arn=os.environ['TASK_ROLE_ARN'],
-                security_groups=[os.environ['SECURITY_GROUP_ID']],
+                **get_fargate_env(),
                 skip_cleanup=True,
                 region_name='ca-central-1'
             )
@@ -331,7 +397,12 @@ async def process_future(f, batch_tasks_lookup, timeout, max_task_tries, tasks_p
             batch_results = await f.result()
     except Exception as e:
         batch_results = [{'return': None, 'exception': e, 'pre_time': None, 'post_time': datetime.datetime.now()} for _ in batch_tasks]
+    process_task_results(batch_tasks, batch_results, max_task_tries, tasks_progress_bar, exception_counter)
+    batch_tasks_lookup[f.key] = (batch_tasks, True)
+
+def process_task_results(batch_tasks, batch_results, max_task_tries, tasks_progress_bar, exception_counter):
     assert len(batch_tasks) == len(batch_results), "Number of tasks and results must match"
+    num_completed = 0
     for t, r in zip(batch_tasks, batch_results):
         if r['exception'] is not None:
             r['exception'] = str(r['exception'])[:100]
@@ -342,16 +413,48 @@ async def process_future(f, batch_tasks_lookup, timeout, max_task_tries, tasks_p
             exception_counter.add(1)
             if len(t.exceptions) >= max_task_tries:
                 t.completed = True
-                tasks_progress_bar.update(1)
+                num_completed += 1
         else:
             t.result = r
             t.completed = True
-            tasks_progress_bar.update(1)
-    batch_tasks_lookup[f.key] = (batch_tasks, True)
+            num_completed += 1
+    # one progress bar update per batch of results, rather than per task
+    if tasks_progress_bar is not None:
+        tasks_progress_bar.update(num_completed)
+    return num_completed
 
-async def get_results(task_futures, batch_tasks_lookup, timeout, max_task_tries, tasks_progress_bar, exception_counter):
-    async for f in dask_as_completed(task_futures, raise_errors=False):
-        await process_future(f, batch_tasks_lookup, timeout, max_task_tries, tasks_progress_bar, exception_counter)
+def process_future_result(f, result, batch_tasks_lookup, max_task_tries, tasks_progress_bar, exception_counter):
+    batch_tasks, processed = batch_tasks_lookup[f.key]
+    if processed:
+        return 0
+    # with raise_errors=False, an errored future comes back as its (type, exception, traceback) tuple,
+    # and a cancelled one as the CancelledError itself
+    if f.status == 'error' and isinstance(result, tuple):
+        result = result[1]
+    if isinstance(result, BaseException):
+        batch_results = [{'return': None, 'exception': result, 'pre_time': None, 'post_time': datetime.datetime.now()} for _ in batch_tasks]
+    else:
+        batch_results = result
+    num_completed = process_task_results(batch_tasks, batch_results, max_task_tries, tasks_progress_bar, exception_counter)
+    batch_tasks_lookup[f.key] = (batch_tasks, True)
+    return num_completed
+
+async def get_results(task_futures, batch_tasks_lookup, timeout, max_task_tries, tasks_progress_bar, batch_progress_bar, exception_counter, submit=None):
+    # results come back with the completed futures, so there's no extra round trip per future to fetch them
+    completed = dask_as_completed(task_futures, with_results=True, raise_errors=False)
+    async for f, result in completed:
+        # handle everything else that has already finished in the same pass
+        finished = [(f, result)] + completed.next_batch(block=False)
+        # the all tasks bar is advanced once for everything drained here, rather than once per future
+        num_completed = 0
+        for f, result in finished:
+            num_completed += process_future_result(f, result, batch_tasks_lookup, max_task_tries, None, exception_counter)
+        tasks_progress_bar.update(num_completed)
+        # advance by the actual number of tasks in these futures' mini batches
+        batch_progress_bar.update(sum(len(batch_tasks_lookup[f.key][0]) for f, _ in finished))
+        if submit is not None:
+            # top the window of in flight mini batches back up by as many as just finished
+            completed.update(submit(len(finished)))
 
 class Counter:
     def __init__(self):
@@ -421,11 +524,21 @@ class TaskDataset:
                 'completed': pl.Boolean
             }
         )
+        # kept up to date as tasks are added and updated, so num_left doesn't scan the frame
+        self.num_completed = 0
+        # every row before this one is completed, so batches are taken from after it
+        self.pending_offset = 0
+        self.batch_rows = []
 
     def add_potential_ids(self, args):
+        # built column-wise from the id array, rather than from a dict per id
+        num_args = len(args)
         new_tasks = pl.DataFrame([
-            {'args': arg, 'result': None, 'exceptions': [], 'completed': False} for arg in args
-            ], schema=self.tasks.schema)
+            pl.Series('args', args, dtype=pl.UInt64),
+            pl.Series('result', [None], dtype=self.tasks.schema['result']).new_from_index(0, num_args),
+            pl.Series('exceptions', [[]], dtype=self.tasks.schema['exceptions']).new_from_index(0, num_args),
+            pl.Series('completed', [False], dtype=pl.Boolean).new_from_index(0, num_args),
+        ])
         self.tasks = pl.concat([self.tasks, new_tasks], how='diagonal_relaxed')
 
     def load_existing_df(self, df):
@@ -447,23 +560,40 @@ class TaskDataset:
                 ])
             )
         ])
+        self.num_completed += df['completed'].sum()
         self.tasks = pl.concat([self.tasks, df], how='diagonal_relaxed')
 
     def get_batch(self, batch_size):
-        task_rows = self.tasks.filter(pl.col('completed') == False).head(batch_size)
-        def create_task_from_row(row):
-            t = DaskTask(row['args'])
-            t.completed = row['completed']
-            t.result = row['result']
-            if isinstance(row['exceptions'], np.ndarray):
-                t.exceptions = row['exceptions'].tolist()
+        # lazy so the head is pushed into the filter, and the scan stops once the batch is full
+        # starting from the first pending row, rather than rescanning all the completed rows before it
+        task_rows = self.tasks.lazy()\
+            .slice(self.pending_offset)\
+            .with_row_index('row', offset=self.pending_offset)\
+            .filter(pl.col('completed').not_())\
+            .head(batch_size)\
+            .collect()
+        if len(task_rows) == 0 and self.pending_offset > 0 and self.num_left() > 0:
+            # shouldn't happen, but rescan from the start rather than lose track of pending tasks
+            self.pending_offset = 0
+            return self.get_batch(batch_size)
+        self.batch_rows = task_rows['row'].to_list()
+        def create_task_from_row(args, result, exceptions, completed):
+            t = DaskTask(args)
+            t.completed = completed
+            t.result = result
+            if isinstance(exceptions, np.ndarray):
+                t.exceptions = exceptions.tolist()
             else:
-                t.exceptions = row['exceptions']
+                t.exceptions = exceptions
             return t
-        tasks = [create_task_from_row(row) for row in task_rows.to_dicts()]
+        # converted column by column, rather than building a dict per row
+        columns = [task_rows[col].to_list() for col in ['args', 'result', 'exceptions', 'completed']]
+        tasks = [create_task_from_row(*row) for row in zip(*columns)]
         return tasks
 
     def update_tasks(self, tasks):
+        # tasks come from get_batch, so any that are completed now were not before
+        self.num_completed += sum(t.completed for t in tasks)
         # Create a DataFrame from the tasks
         updates_df = pl.DataFrame(
             {
@@ -476,41 +606,66 @@ class TaskDataset:
         )
         
         # Update the existing DataFrame using join and coalesce
-        self.tasks = self.tasks.join(
+        # the batch only has rows from pending_offset on, so the completed rows before it are left out of the join
+        # and the row order is kept, as pending_offset and batch_rows are row positions
+        updated_tasks = self.tasks.slice(self.pending_offset).with_row_index().join(
                 updates_df,
                 on="args",
                 how="left"
             )\
+            .sort("index")\
             .with_columns([
                 pl.col("result_right").fill_null(pl.col("result")),
                 pl.col("exceptions_right").fill_null(pl.col("exceptions")),
                 pl.col("completed_right").fill_null(pl.col("completed"))
             ])\
-            .drop(["result", "exceptions", "completed"])\
+            .drop(["index", "result", "exceptions", "completed"])\
             .rename({'result_right': 'result', 'exceptions_right': 'exceptions', 'completed_right': 'completed'})
+        self.tasks = pl.concat([self.tasks.slice(0, self.pending_offset), updated_tasks], how='vertical_relaxed', rechunk=False)
+
+        # the batch was the first pending rows after the offset, so everything up to its end is now completed,
+        # apart from any of its tasks left to retry
+        if tasks and len(self.batch_rows) == len(tasks):
+            retry_rows = [row for row, t in zip(self.batch_rows, tasks) if not t.completed]
+            self.pending_offset = retry_rows[0] if retry_rows else self.batch_rows[-1] + 1
+        self.batch_rows = []
         
     
     def num_left(self):
-        return len(self.tasks.filter(pl.col('completed') == False))
+        return len(self.tasks) - self.num_completed
     
     def __len__(self):
         return len(self.tasks)
 
-async def dask_map(function, dataset, num_workers=16, reqs_per_ip=1000, batch_size=100000, task_batch_size=1000, max_task_tries=5, task_nthreads=1, task_timeout=10, worker_cpu=256, worker_mem=512, cluster_type='local'):
+def call_scattered(args, function=None):
+    return function(args)
+
+async def dask_map(function, dataset, num_workers=16, reqs_per_ip=1000, batch_size=100000, task_batch_size=1000, max_task_tries=5, task_nthreads=1, task_timeout=10, worker_cpu=256, worker_mem=512, cluster_type='local', submit_chunk_size=500, max_inflight_chunks=None, async_function=None):
     network_interfaces = ['eth0'] if cluster_type in ['ssh', 'slurm'] else [None]
     interface_ratios = [1.0] if cluster_type in ['ssh', 'slurm'] else [1]
     assert all(int(ratio * task_nthreads) > 0 for ratio in interface_ratios), "Must have at least one thread per network interface"
-    function = MultiNetworkInterfaceFunc(DaskFunc(function), network_interfaces=network_interfaces, ratios=interface_ratios, task_nthreads=task_nthreads)
+    if async_function is not None and network_interfaces == [None]:
+        function = AsyncBatchFunc(async_function, task_nthreads=task_nthreads, task_timeout=task_timeout)
+    else:
+        function = MultiNetworkInterfaceFunc(DaskFunc(function), network_interfaces=network_interfaces, ratios=interface_ratios, task_nthreads=task_nthreads)
     # network_interface = None # 'wlan0' if cluster_type == 'raspi' else None
     # function = BatchNetworkInterfaceFunc(DaskFunc(function), network_interface=network_interface, task_nthreads=task_nthreads)
-    dotenv.load_dotenv()
-    tasks_progress_bar = tqdm(total=dataset.num_left(), desc="All Tasks")
-    batch_progress_bar = tqdm(total=min(batch_size, dataset.num_left()), desc="Batch Tasks", leave=False)
+    # the .env file is loaded once in async_main, so these are only read here rather than on every IP change
+    if cluster_type == 'ssh' or cluster_type == 'slurm':
+        wlan_username = os.environ['EDUROAM_USERNAME']
+        wlan_password = os.environ['EDUROAM_PASSWORD']
+        slurm_account_password = os.environ['SCHEDULER_PASSWORD']
+    # mini batches are submitted as a rolling window, so only this many futures are pending at once
+    max_inflight_chunks = max_inflight_chunks or num_workers * 4
+    # counting the tasks left scans the whole dataset, so only recount when tasks are updated
+    num_left = dataset.num_left()
+    tasks_progress_bar = tqdm(total=num_left, desc="All Tasks", mininterval=0.5)
+    batch_progress_bar = tqdm(total=min(batch_size, num_left), desc="Batch Tasks", leave=False, mininterval=0.5)
 
     num_cluster_errors = 0
     max_cluster_errors = 3
 
-    while dataset.num_left() > 0:
+    while num_left > 0:
         try:
             cluster_manager = ClusterManager()
             async with DaskCluster(cluster_type, cluster_manager, worker_cpu=worker_cpu, worker_mem=worker_mem) as cluster:
@@ -518,20 +673,30 @@ async def dask_map(function, dataset, num_workers=16, reqs_per_ip=1000, batch_si
                     if cluster_type == 'fargate':
                         cluster.adapt(minimum=1, maximum=num_workers)
                         # wait for workers to start
-                        client.wait_for_workers(1, timeout=120)
+                        await client.wait_for_workers(1, timeout=120)
+                    # send the function to the workers once, rather than pickling it into every batch of tasks
+                    function_future = await client.scatter(function, broadcast=True, hash=False)
                     num_reqs_for_current_ips = 0
                     num_exceptions_for_current_ips = 0
-                    while dataset.num_left() > 0:
+                    worker_refresh = None
+                    while num_left > 0:
                         try:
-                            current_batch_size = min(batch_size, dataset.num_left())
+                            current_batch_size = min(batch_size, num_left)
 
                             # prepping args for mapping 
                             # batching tasks as we want to avoid having dask tasks that are too small
-                            all_batch_tasks = dataset.get_batch(current_batch_size)
-                            batch_tasks = []
-                            for i in range(0, len(all_batch_tasks), task_batch_size):
-                                batch_tasks.append(all_batch_tasks[i:i+task_batch_size])
-                            batch_args = [[t.args for t in batch] for batch in batch_tasks]
+                            # in a thread, so the event loop stays free to run any worker refresh meanwhile
+                            all_batch_tasks = await asyncio.to_thread(dataset.get_batch, current_batch_size)
+                            # the args are gathered in one pass, and each mini batch is then a tuple slice of them
+                            all_batch_args = tuple(t.args for t in all_batch_tasks)
+                            mini_batch_starts = range(0, len(all_batch_tasks), task_batch_size)
+                            batch_tasks = [all_batch_tasks[i:i+task_batch_size] for i in mini_batch_starts]
+                            batch_args = [all_batch_args[i:i+task_batch_size] for i in mini_batch_starts]
+
+                            # the batch above was prepared while any worker refresh ran, now the new workers are needed
+                            if worker_refresh is not None:
+                                refresh, worker_refresh = worker_refresh, None
+                                function_future = await refresh
 
                             num_reqs_for_current_ips += current_batch_size
 
@@ -539,41 +704,56 @@ async def dask_map(function, dataset, num_workers=16, reqs_per_ip=1000, batch_si
                             batch_progress_bar.reset(total=current_batch_size)
 
                             # start the timeout timer
-                            total_time = sum(len(b) for b in batch_tasks) * task_timeout
+                            total_time = len(all_batch_tasks) * task_timeout
                             num_actual_workers = len(cluster.workers)
                             if num_actual_workers == 0:
                                 num_actual_workers = 1
                             timeout = total_time / (num_actual_workers * task_nthreads)
 
                             # send out the tasks
-                            task_futures = client.map(function, batch_args)
-                            batch_tasks_lookup = {f.key: (mini_batch_tasks, False) for mini_batch_tasks, f in zip(batch_tasks, task_futures)}
-                            for f in task_futures:
-                                # TODO update with specific task arg size, not larger batch size
-                                f.add_done_callback(lambda _: batch_progress_bar.update(task_batch_size))
+                            # impure so the scheduler doesn't spend time tokenizing the args to dedupe keys
+                            task_futures = []
+                            batch_tasks_lookup = {}
+                            unsubmitted = zip(batch_tasks, batch_args)
+
+                            def submit(num_chunks):
+                                chunk = list(itertools.islice(unsubmitted, num_chunks))
+                                if not chunk:
+                                    return []
+                                futures = client.map(call_scattered, [mini_batch_args for _, mini_batch_args in chunk], function=function_future, pure=False)
+                                for (mini_batch_tasks, _), f in zip(chunk, futures):
+                                    batch_tasks_lookup[f.key] = (mini_batch_tasks, False)
+                                task_futures.extend(futures)
+                                return futures
+
+                            # fill the initial window in chunks, so the scheduler gets several small graph updates it can pipeline,
+                            # then get_results submits another mini batch each time one finishes
+                            while len(task_futures) < max_inflight_chunks and submit(min(submit_chunk_size, max_inflight_chunks - len(task_futures))):
+                                await asyncio.sleep(0)
 
                             # wait for the futures to complete, with a timeout
                             # get all the results
                             exception_counter = Counter()
                             try:
-                                await asyncio.wait_for(get_results(task_futures, batch_tasks_lookup, timeout, max_task_tries, tasks_progress_bar, exception_counter), timeout=timeout)
+                                await asyncio.wait_for(get_results(list(task_futures), batch_tasks_lookup, timeout, max_task_tries, tasks_progress_bar, batch_progress_bar, exception_counter, submit=submit), timeout=timeout)
                             except Exception as e:
                                 # cancel all the unfinished tasks, and add the exceptions to the task
+                                # mini batches that were never submitted are left as they are, to be picked up in the next batch
                                 for f in task_futures:
                                     await process_future(f, batch_tasks_lookup, timeout, max_task_tries, tasks_progress_bar, exception_counter, cancel_if_unfinished=True)
 
                             dataset.update_tasks(all_batch_tasks)
+                            num_left = dataset.num_left()
                             num_exceptions_for_current_ips += exception_counter.count
 
                             # check if we need to recreate workers
-                            if dataset.num_left() > 0 and num_reqs_for_current_ips >= reqs_per_ip * num_actual_workers:
+                            if num_left > 0 and num_reqs_for_current_ips >= reqs_per_ip * num_actual_workers:
                                 # recreate workers to get new IPs
                                 if cluster_type == 'fargate':
-                                    cluster.scale(0)
-                                    wait_until(lambda: len(client.scheduler_info()['workers']) == 0, timeout=120)
                                     num_reqs_for_current_ips = 0
-                                    cluster.adapt(minimum=1, maximum=num_workers)
-                                    client.wait_for_workers(1, timeout=120)
+                                    # run in the background, so the old workers shut down and the new ones start
+                                    # while the next batch is taken from the dataset
+                                    worker_refresh = asyncio.create_task(refresh_fargate_workers(cluster, client, function, num_workers))
                                 elif cluster_type == 'ssh' or cluster_type == 'slurm':
                                     # reset mac address of raspberry pis and rescan for the new assigned IPs
                                     print("Changing worker IPs...")
@@ -581,9 +761,6 @@ async def dask_map(function, dataset, num_workers=16, reqs_per_ip=1000, batch_si
                                     num_reqs_for_current_ips = 0
                                     num_exceptions_for_current_ips = 0
                                     # await cluster_manager.change_mac_addresses()
-                                    wlan_username = os.environ['EDUROAM_USERNAME']
-                                    wlan_password = os.environ['EDUROAM_PASSWORD']
-                                    slurm_account_password = os.environ['SCHEDULER_PASSWORD']
                                     res = await client.run(
                                         change_mac_address, 
                                         wlan_username, 
@@ -616,6 +793,30 @@ async def dask_map(function, dataset, num_workers=16, reqs_per_ip=1000, batch_si
 
     return
 
+async def async_map(function, dataset, num_workers=16, batch_size=100000, max_task_tries=5, task_timeout=10, max_inflight=None):
+    num_left = dataset.num_left()
+    tasks_progress_bar = tqdm(total=num_left, desc="All Tasks", mininterval=0.5)
+    exception_counter = Counter()
+
+    # one pooled client for the whole run, so connections are reused rather than set up per video.
+    # the pool bounds the requests actually in flight, num_workers unless set, while twice as many tasks run,
+    # so a connection freed by a task still parsing its page goes straight to the next request.
+    # waiting for a free connection doesn't count against a task's timeout
+    max_inflight = max_inflight or num_workers
+    num_tasks = 2 * max_inflight
+    limits = httpx.Limits(max_connections=max_inflight, max_keepalive_connections=max_inflight)
+    timeout = httpx.Timeout(task_timeout, pool=None)
+    async with httpx.AsyncClient(limits=limits, timeout=timeout, headers=HEADERS) as client:
+        function = AsyncDaskFunc(functools.partial(function, client=client))
+        while num_left > 0:
+            current_batch_size = min(batch_size, num_left)
+            batch_tasks = dataset.get_batch(current_batch_size)
+            batch_results = await async_amap(function, [t.args for t in batch_tasks], num_workers=num_tasks, progress_bar=True, pbar_desc="Batch Tasks")
+            process_task_results(batch_tasks, batch_results, max_task_tries, tasks_progress_bar, exception_counter)
+            dataset.update_tasks(batch_tasks)
+            num_left = dataset.num_left()
+    tasks_progress_bar.close()
+
 class InvalidResponseException(Exception):
     pass
 
@@ -626,62 +827,70 @@ class RestartClusterException(Exception):
     pass
 
 
-def get_headers():
-    # TODO different user agent results in different html encoding, need to update process video class for each user agent
-    # software_names = [rug_params.SoftwareName.CHROME.value, rug_params.SoftwareName.FIREFOX.value]
-    # operating_systems = [rug_params.OperatingSystem.WINDOWS.value, rug_params.OperatingSystem.ANDROID.value, rug_params.OperatingSystem.IOS.value, rug_params.OperatingSystem.MAC_OS_X.value]   
-    
-    # user_agent_rotator = rug_user_agent.UserAgent(software_names=software_names, operating_systems=operating_systems, limit=100)
+# TODO different user agent results in different html encoding, need to update process video class for each user agent
+# software_names = [rug_params.SoftwareName.CHROME.value, rug_params.SoftwareName.FIREFOX.value]
+# operating_systems = [rug_params.OperatingSystem.WINDOWS.value, rug_params.OperatingSystem.ANDROID.value, rug_params.OperatingSystem.IOS.value, rug_params.OperatingSystem.MAC_OS_X.value]   
 
-    # # Get Random User Agent String.
-    # user_agent = user_agent_rotator.get_random_user_agent()
-    
-    headers = {
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-        'Accept-Encoding': 'gzip, deflate, br',
-        'Accept-Language': 'en-CA',
-        'Sec-Fetch-Dest': 'document',
-        'Sec-Fetch-Mode': 'navigate',
-        'Sec-Fetch-Site': 'none',
-        'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.0 Safari/605.1.15'
-    }
-    return headers
+# user_agent_rotator = rug_user_agent.UserAgent(software_names=software_names, operating_systems=operating_systems, limit=100)
+
+# # Get Random User Agent String.
+# user_agent = user_agent_rotator.get_random_user_agent()
+
+# static, so built once and shared read-only by every request
+HEADERS = MappingProxyType({
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+    'Accept-Encoding': 'gzip, deflate, br',
+    'Accept-Language': 'en-CA',
+    'Sec-Fetch-Dest': 'document',
+    'Sec-Fetch-Mode': 'navigate',
+    'Sec-Fetch-Site': 'none',
+    'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.0 Safari/605.1.15'
+})
+# the same headers as curl header lines, so they aren't formatted again for every request
+CURL_HEADERS = [f"{key}: {value}" for key, value in HEADERS.items()]
 
 class ProcessVideo:
+    # literal markers around the video detail JSON, shared by every instance;
+    # bytes.find on these literals is faster than a compiled regex over the same window
+    json_start = b'"webapp.video-detail":'
+    json_end = b',"webapp.a-b":'
+
     def __init__(self, headers=None):
-        self.text = ""
+        # until the start marker is found only a marker-sized tail of the page is kept,
+        # after that the buffer holds just the JSON body, so each byte is only searched once
+        self.buf = bytearray()
+        self.scan_start = 0
         self.headers = headers
         self.start = -1
-        self.json_start = '"webapp.video-detail":'
-        self.json_start_len = len(self.json_start)
         self.end = -1
-        self.json_end = ',"webapp.a-b":'
+        self.payload = None
     
-    def process_chunk(self, text_chunk):
-        self.text += text_chunk
-        if len(self.text) < self.json_start_len:
-            return 'continue'
+    def process_chunk(self, chunk):
+        self.buf += chunk
         if self.start == -1:
-            self.start = self.text.find(self.json_start)
-            if self.start != -1:
-                self.text = self.text[self.start + self.json_start_len:]
-                self.start = 0
-        if self.start != -1:
-            self.end = self.text.find(self.json_end)
-            if self.end != -1:
-                self.text = self.text[:self.end]
-                return 'break'
-        return 'continue'
+            start = self.buf.find(self.json_start)
+            if start == -1:
+                # the marker may be split across chunks, so keep the tail for the next chunk
+                del self.buf[:max(0, len(self.buf) - len(self.json_start) + 1)]
+                return 'continue'
+            del self.buf[:start + len(self.json_start)]
+            self.start = 0
+        self.end = self.buf.find(self.json_end, self.scan_start)
+        if self.end == -1:
+            self.scan_start = max(0, len(self.buf) - len(self.json_end) + 1)
+            return 'continue'
+        self.payload = bytes(self.buf[:self.end])
+        return 'break'
             
     def process_response(self):
-        if self.start == -1 or self.end == -1:
-            err_data = {'text': self.text}
+        if self.payload is None:
+            err_data = {'text': self.buf.decode('utf-8', errors='ignore')}
             if self.headers:
                 err_data['headers'] = self.headers
             raise InvalidResponseException(
                 "Could not find normal JSON section in returned HTML."
             )
-        video_detail = json.loads(self.text)
+        video_detail = json_loads(self.payload)
         if video_detail.get("statusCode", 0) != 0: # assume 0 if not present
             # TODO retry when status indicates server error
             return video_detail
@@ -692,16 +901,28 @@ class ProcessVideo:
             )
         return video_info
 
-def process_video(text, headers=None):
+def process_video(content, headers=None):
     video_processor = ProcessVideo(headers=headers)
-    video_processor.process_chunk(text)
+    # the whole page is already in memory, so slice the JSON straight out of it
+    # rather than copying the page through the streaming buffer
+    start = content.find(ProcessVideo.json_start)
+    if start != -1:
+        start += len(ProcessVideo.json_start)
+        end = content.find(ProcessVideo.json_end, start)
+        if end != -1:
+            video_processor.payload = content[start:end]
+            return video_processor.process_response()
+    video_processor.process_chunk(content)
     return video_processor.process_response()
 
 class PyCurlResponse:
     status_code: int
     headers: dict
     content: bytes
-    text: str
+
+    @property
+    def text(self) -> str:
+        return self.content.decode('utf-8')
 
 class PyCurlClient:
     def __init__(self, share=None, network_interface=None):
@@ -712,8 +933,10 @@ class PyCurlClient:
 
     def _setup(self, url, headers):
         self.buffer = io.BytesIO()
+        self.response_headers = {}
         self.c.setopt(pycurl.URL, url)
-        self.c.setopt(pycurl.HTTPHEADER, [f"{key}: {value}" for key, value in headers.items()])
+        header_lines = CURL_HEADERS if headers is HEADERS else [f"{key}: {value}" for key, value in headers.items()]
+        self.c.setopt(pycurl.HTTPHEADER, header_lines)
         self.c.setopt(pycurl.TIMEOUT, 10)
         self.c.setopt(pycurl.WRITEFUNCTION, self.buffer.write)
         self.c.setopt(pycurl.HEADERFUNCTION, self._header_function)
@@ -745,8 +968,6 @@ class PyCurlClient:
         else:
             resp.content = resp_bytes
 
-        resp.text = resp.content.decode('utf-8')
-
         self.buffer.close()
 
         return resp
@@ -770,22 +991,56 @@ class PyCurlClient:
         self.c.close()
 
 
+async def async_get_video(video_id, client):
+    url = f"https://www.tiktok.com/@/video/{video_id}"
+
+    # the client carries HEADERS as its defaults, so they aren't merged in per request
+    async with client.stream("GET", url) as r:
+        if r.status_code >= 300:
+            raise InvalidResponseException(f"Status code: {r.status_code}")
+
+        # cannot get resolved user, tiktok doesn't redirect when video is hidden
+        video_processor = ProcessVideo(headers=r.headers)
+        async for chunk in r.aiter_bytes():
+            if video_processor.process_chunk(chunk) == 'break':
+                break
+    return video_processor.process_response()
+
+_curl_clients = ThreadLocalCache()
+
+def get_curl_client(network_interface):
+    # a curl handle keeps its connections alive between requests,
+    # so reuse one per thread and network interface rather than one per request
+    return _curl_clients.get(network_interface, lambda: PyCurlClient(network_interface=network_interface))
+
+_async_batch_loops = ThreadLocalCache()
+
+def get_async_batch_loop():
+    # keep one event loop per thread open between batches, so the async clients bound to it stay usable
+    return _async_batch_loops.get(None, lambda: uvloop.new_event_loop() if uvloop is not None else asyncio.new_event_loop())
+
+_async_clients = ThreadLocalCache()
+
+def get_async_client(task_nthreads, task_timeout):
+    # like the curl handles, the pooled client lives for the life of the worker thread,
+    # so connections are reused across batches rather than set up again for each one
+    def make_client():
+        limits = httpx.Limits(max_connections=task_nthreads, max_keepalive_connections=task_nthreads)
+        return httpx.AsyncClient(limits=limits, timeout=task_timeout, headers=HEADERS)
+    return _async_clients.get((task_nthreads, task_timeout), make_client)
+
 def get_video(video_id, network_interface):
     url = f"https://www.tiktok.com/@/video/{video_id}"
-    headers = get_headers()
     
-    client = PyCurlClient(network_interface=network_interface)
-    resp = client.get(url, headers=headers)
-    client.close()
+    client = get_curl_client(network_interface)
+    resp = client.get(url, headers=HEADERS)
 
     if resp.status_code >= 300:
         raise InvalidResponseException(f"Status code: {resp.status_code}")
 
-    resp_html = resp.text
-
     # cannot get resolved user, tiktok doesn't redirect when video is hidden
     video_processor = ProcessVideo(headers=resp.headers)
-    video_processor.process_chunk(resp_html)
+    video_processor.process_chunk(resp.content)
     return video_processor.process_response()
 
 class DaskFunc:
@@ -810,14 +1065,40 @@ class DaskFunc:
             'post_time': post_time,
         }
     
+class AsyncDaskFunc:
+    def __init__(self, func):
+        self.func = func
+
+    async def __call__(self, *args):
+        
+        pre_time = datetime.datetime.now()
+        try:
+            res = await self.func(*args)
+            exception = None
+        except Exception as e:
+            res = None
+            exception = {'ex': e}
+        post_time = datetime.datetime.now()
+
+        return {
+            'return': res,
+            'exception': exception,
+            'pre_time': pre_time,
+            'post_time': post_time,
+        }
+    
 class BatchNetworkInterfaceFunc:
     def __init__(self, func, network_interface=None, task_nthreads=1):
         self.func = func
         self.network_interface = network_interface
         self.task_nthreads = task_nthreads
+        # a long-lived pool for each worker thread running batches, so each batch doesn't have to start new threads,
+        # and concurrent batches don't queue behind each other
+        self.executors = ThreadLocalCache()
 
     def __call__(self, batch_args):
-        return thread_map(batch_args, itertools.repeat(self.network_interface), function=self.func, num_workers=self.task_nthreads)
+        executor = self.executors.get(None, lambda: ThreadPoolExecutor(max_workers=self.task_nthreads))
+        return thread_map(batch_args, itertools.repeat(self.network_interface), function=self.func, executor=executor)
         
 class MultiNetworkInterfaceFunc:
     def __init__(self, func, network_interfaces=[], ratios=[], task_nthreads=1):
@@ -827,29 +1108,61 @@ class MultiNetworkInterfaceFunc:
         self.task_nthreads = task_nthreads
         self.network_interfaces = network_interfaces
         self.ratios = ratios
+        # one batch function per network interface, each with its own thread pools
+        self.network_interface_funcs = [
+            BatchNetworkInterfaceFunc(func, network_interface=network_interface, task_nthreads=int(task_nthreads * ratio))
+            for network_interface, ratio in zip(network_interfaces, ratios)
+        ]
+        # separate from the interfaces' pools, as these threads block waiting on them
+        self.executors = ThreadLocalCache()
 
     def __call__(self, batch_args):
         # TODO use httpx again for default interface
-        executor = ThreadPoolExecutor(max_workers=len(self.network_interfaces))
-        all_func_args = []
+        executor = self.executors.get(None, lambda: ThreadPoolExecutor(max_workers=len(self.network_interfaces)))
         cum_ratios = [sum(self.ratios[:i]) for i in range(len(self.ratios) + 1)]
-        for i in range(len(self.ratios)):
-            all_func_args.append(batch_args[int(len(batch_args) * cum_ratios[i]):int(len(batch_args) * cum_ratios[i+1])])
-        assert sum(len(args) for args in all_func_args) == len(batch_args), "Number of batch args must match number of all batch args"
+        bounds = [int(len(batch_args) * cum_ratio) for cum_ratio in cum_ratios]
+        assert bounds[0] == 0 and bounds[-1] == len(batch_args), "Number of batch args must match number of all batch args"
         
         futures = []
         # TODO add httpx option back for network interface that doesn't need it
-        for network_interface, ratio, func_args in zip(self.network_interfaces, self.ratios, all_func_args):
-            func_nthreads = int(self.task_nthreads * ratio)
-            network_interface_func = BatchNetworkInterfaceFunc(self.func, network_interface=network_interface, task_nthreads=func_nthreads)
-            future = executor.submit(network_interface_func, func_args)
+        for i, network_interface_func in enumerate(self.network_interface_funcs):
+            future = executor.submit(network_interface_func, batch_args[bounds[i]:bounds[i+1]])
             futures.append(future)
 
-        results = [future.result() for future in futures]
-        return [r for result in results for r in result]
+        # each interface's results are written back over its own slice, in the same order as batch_args,
+        # rather than flattening a list of lists
+        results = [None] * len(batch_args)
+        for i, future in enumerate(futures):
+            results[bounds[i]:bounds[i+1]] = future.result()
+        return results
         
     
+class AsyncBatchFunc:
+    # for workers that don't need to bind requests to a network interface,
+    # a batch is run as one event loop over a shared client rather than a pool of threads
+    def __init__(self, func, task_nthreads=1, task_timeout=10):
+        self.func = func
+        self.task_nthreads = task_nthreads
+        self.task_timeout = task_timeout
+
+    def __call__(self, batch_args):
+        return get_async_batch_loop().run_until_complete(self.run(batch_args))
+
+    async def run(self, batch_args):
+        client = get_async_client(self.task_nthreads, self.task_timeout)
+        func = AsyncDaskFunc(functools.partial(self.func, client=client))
+        semaphore = asyncio.Semaphore(self.task_nthreads)
+
+        async def run_task(args):
+            async with semaphore:
+                return await func(args)
+
+        return await asyncio.gather(*(run_task(args) for args in batch_args))
+
 class DaskTask:
+    # one of these per task in a batch, so skip the per-instance __dict__
+    __slots__ = ('args', 'exceptions', 'result', 'completed')
+
     def __init__(self, args):
         self.args = args
         self.exceptions = []
@@ -857,6 +1170,56 @@ class DaskTask:
         self.completed = False
     
 
+def load_other_bits(generation_strategy):
+    this_dir_path = os.path.dirname(os.path.realpath(__file__))
+    json_path = os.path.join(this_dir_path, '..', '..', 'figs', 'all_videos', f'{generation_strategy}_two_segments_combinations.json')
+    # the combinations file only changes when regenerated, so cache the packed ints beside it
+    cache_path = os.path.join(this_dir_path, '..', '..', 'figs', 'all_videos', f'{generation_strategy}_two_segments_combinations.pkl')
+    if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(json_path):
+        with open(cache_path, 'rb') as file:
+            return pickle.load(file)
+
+    with open(json_path, 'r') as file:
+        data = json.load(file)
+
+    # get bits of non timestamp sections of ID
+    # order dict according to interval
+    data = [(tuple(map(int, interval.strip('()').split(', '))), vals) for interval, vals in data.items()]
+    data = sorted(data, key=lambda x: x[0][0])
+    # get rid of millisecond bits
+    data = [t for t in data if t[0] != (0,9)]
+    intervals = [d[0] for d in data]
+    # pack each combination of interval values into the bits below the timestamp
+    interval_widths = [interval[1] - interval[0] + 1 for interval in intervals]
+    other_bits_width = sum(interval_widths)
+    # broadcast each interval's values against the combinations so far, giving the same order as itertools.product
+    other_ints = np.zeros(1, dtype=np.uint64)
+    for width, (_, vals) in zip(interval_widths, data):
+        other_ints = ((other_ints[:, None] << np.uint64(width)) | np.array(vals, dtype=np.uint64)[None, :]).ravel()
+
+    with open(cache_path, 'wb') as file:
+        pickle.dump((intervals, other_ints, other_bits_width), file, protocol=5)
+    return intervals, other_ints, other_bits_width
+
+def _pack_video_ids(timestamp_arr, other_arr, other_bits_width):
+    # outer product of timestamps and other bits, in the same row major order as itertools.product
+    return ((timestamp_arr[:, None] << np.uint64(other_bits_width)) | other_arr[None, :]).ravel()
+
+if numba is not None:
+    # cached so later runs load the compiled kernel instead of paying the JIT compile again
+    @numba.njit(parallel=True, cache=True)
+    def pack_video_ids(timestamp_arr, other_arr, other_bits_width):
+        num_others = other_arr.size
+        ids = np.empty(timestamp_arr.size * num_others, dtype=np.uint64)
+        shift = np.uint64(other_bits_width)
+        for i in numba.prange(timestamp_arr.size):
+            base = timestamp_arr[i] << shift
+            for j in range(num_others):
+                ids[i * num_others + j] = base | other_arr[j]
+        return ids
+else:
+    pack_video_ids = _pack_video_ids
+
 async def get_random_sample(
         generation_strategy,
         start_time,
@@ -872,29 +1235,13 @@ async def get_random_sample(
         worker_cpu,
         worker_mem,
         cluster_type,
-        method
+        method,
+        max_inflight=None
     ):
     print(f"Getting random sample at {start_time} for {num_time} {time_unit}")
     this_dir_path = os.path.dirname(os.path.realpath(__file__))
     
-    with open(os.path.join(this_dir_path, '..', '..', 'figs', 'all_videos', f'{generation_strategy}_two_segments_combinations.json'), 'r') as file:
-        data = json.load(file)
-
-    # get bits of non timestamp sections of ID
-    # order dict according to interval
-    data = [(tuple(map(int, interval.strip('()').split(', '))), vals) for interval, vals in data.items()]
-    data = sorted(data, key=lambda x: x[0][0])
-    # get rid of millisecond bits
-    data = [t for t in data if t[0] != (0,9)]
-    interval_bits = []
-    intervals = [d[0] for d in data]
-    for interval, vals in data:
-        # format ints to binary
-        num_bits = interval[1] - interval[0] + 1
-        bits = [format(i, f'0{num_bits}b') for i in vals]
-        interval_bits.append(bits)
-    other_bit_sequences = itertools.product(*interval_bits)
-    other_bit_sequences = [''.join(bits) for bits in other_bit_sequences]
+    intervals, other_ints, other_bits_width = load_other_bits(generation_strategy)
 
     # get all videos in 1 millisecond
     
@@ -906,19 +1253,14 @@ async def get_random_sample(
     time_delta = datetime.timedelta(**{unit_map[time_unit]: num_time})
     
     end_time = start_time + time_delta
-    c_time = start_time
-    all_timestamp_bits = []
-    while c_time < end_time:
-        unix_timestamp_bits = format(int(c_time.timestamp()), '032b')
-        milliseconds = int(format(c_time.timestamp(), '.3f').split('.')[1])
-        milliseconds_bits = format(milliseconds, '010b')
-        timestamp_bits = unix_timestamp_bits + milliseconds_bits
-        all_timestamp_bits.append(timestamp_bits)
-        c_time += datetime.timedelta(milliseconds=1)
-
-    potential_video_bits = itertools.product(all_timestamp_bits, other_bit_sequences)
-    potential_video_bits = [''.join(bits) for bits in potential_video_bits]
-    potential_video_ids = [int(bits, 2) for bits in potential_video_bits]
+    # every millisecond in the window, as integer epoch milliseconds
+    start_epoch_ms = int(start_time.timestamp()) * 1000 + start_time.microsecond // 1000
+    num_ms = -(-time_delta // datetime.timedelta(milliseconds=1))
+    epoch_ms = np.uint64(start_epoch_ms) + np.arange(num_ms, dtype=np.uint64)
+    # 32 bits of unix seconds followed by 10 bits of milliseconds
+    timestamp_arr = ((epoch_ms // np.uint64(1000)) << np.uint64(10)) | (epoch_ms % np.uint64(1000))
+    other_arr = np.array(other_ints, dtype=np.uint64)
+    potential_video_ids = pack_video_ids(timestamp_arr, other_arr, other_bits_width)
 
     date_dir = start_time.strftime('%Y_%m_%d')
     results_dir_path = os.path.join(this_dir_path, '..', '..', 'data', 'results', date_dir, 'hours', str(start_time.hour), str(start_time.minute), str(start_time.second))
@@ -936,8 +1278,8 @@ async def get_random_sample(
             dataset.load_existing_df(existing_df)
 
             # add ids that haven't been collected
-            existing_ids = set(existing_df['args'])
-            potential_video_ids = [i for i in potential_video_ids if i not in existing_ids]
+            existing_ids = existing_df['args'].cast(pl.UInt64).to_numpy()
+            potential_video_ids = potential_video_ids[~np.isin(potential_video_ids, existing_ids)]
             dataset.add_potential_ids(potential_video_ids)
             existing_df = None
 
@@ -949,28 +1291,37 @@ async def get_random_sample(
         dataset.add_potential_ids(potential_video_ids)
 
     if method == 'async':
-        raise NotImplementedError("Async method not implemented")
-        dataset = await async_map(async_get_video, dataset, num_workers=num_workers)
+        map_coroutine = async_map(
+            async_get_video,
+            dataset,
+            num_workers=num_workers,
+            batch_size=batch_size,
+            max_task_tries=max_task_tries,
+            task_timeout=task_timeout,
+            max_inflight=max_inflight
+        )
     elif method == 'dask':
-        try:
-            await asyncio.wait_for(dask_map(
-                get_video, 
-                dataset, 
-                num_workers=num_workers, 
-                reqs_per_ip=reqs_per_ip, 
-                batch_size=batch_size,
-                task_batch_size=task_batch_size,
-                task_timeout=task_timeout,
-                task_nthreads=task_nthreads, 
-                max_task_tries=max_task_tries,
-                worker_cpu=worker_cpu, 
-                worker_mem=worker_mem,
-                cluster_type=cluster_type
-            ), timeout=60 * 60)
-        except asyncio.exceptions.TimeoutError:
-            print(f"Ran out of time to complete task, saving current results")
+        map_coroutine = dask_map(
+            get_video, 
+            dataset, 
+            num_workers=num_workers, 
+            reqs_per_ip=reqs_per_ip, 
+            batch_size=batch_size,
+            task_batch_size=task_batch_size,
+            task_timeout=task_timeout,
+            task_nthreads=task_nthreads, 
+            max_task_tries=max_task_tries,
+            worker_cpu=worker_cpu, 
+            worker_mem=worker_mem,
+            cluster_type=cluster_type,
+            async_function=async_get_video
+        )
     else:
         raise ValueError("Invalid method")
+    try:
+        await asyncio.wait_for(map_coroutine, timeout=60 * 60)
+    except asyncio.exceptions.TimeoutError:
+        print(f"Ran out of time to complete task, saving current results")
     results = dataset.tasks
     num_hits = len(dataset.tasks.filter(pl.col('result').struct.field('return').struct.field('id').is_not_null()))
     num_valid = len(results.filter(pl.col('result').map_elements(lambda x: x is not None and x['return'] is not None, pl.Boolean)))
@@ -999,6 +1350,7 @@ async def get_random_sample(
         'worker_cpu': worker_cpu,
         'worker_mem': worker_mem,
         'cluster_type': cluster_type,
+        'max_inflight': max_inflight,
         'generation_strategy': generation_strategy,
         'intervals': intervals,
     }
@@ -1056,7 +1408,8 @@ async def run_random_sample(config):
             config.worker_cpu,
             config.worker_mem,
             config.cluster_type,
-            config.method
+            config.method,
+            max_inflight=config.get('max_inflight', None)
         )
 
 
@@ -1090,7 +1443,8 @@ async def run_min_each_hour_sample(config):
             config.worker_cpu,
             config.worker_mem,
             config.cluster_type,
-            config.method
+            config.method,
+            max_inflight=config.get('max_inflight', None)
         )
 
 async def run_sec_each_hour_sample(config):
@@ -1122,7 +1476,8 @@ async def run_sec_each_hour_sample(config):
             config.worker_cpu,
             config.worker_mem,
             config.cluster_type,
-            config.method
+            config.method,
+            max_inflight=config.get('max_inflight', None)
         )
 
 def get_ip(_, network_interface):
@@ -1155,6 +1510,9 @@ async def async_main(config):
 
 @hydra.main(config_path='../../config', config_name='config')
 def main(config):
+    # uvloop is a faster drop-in event loop for the high concurrency fetch path
+    if uvloop is not None:
+        uvloop.install()
     asyncio.run(async_main(config))
 
 if __name__ == '__main__':
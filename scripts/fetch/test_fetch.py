@@ -1,9 +1,17 @@
+import asyncio
 import datetime
 import os
 
+import cloudpickle
+from dask.distributed import Client as DaskClient
+from dask.distributed import LocalCluster as DaskLocalCluster
+import httpx
 import polars as pl
+from tqdm import tqdm
 
-from get_random_sample import TaskDataset
+import get_random_sample
+from get_random_sample import TaskDataset, DaskTask, Counter, get_results, async_get_video, async_map, InvalidResponseException, HEADERS
+from get_random_sample import DaskFunc, MultiNetworkInterfaceFunc, AsyncBatchFunc, get_video, get_curl_client, thread_map
 
 def test_task_dataset():
     potential_video_ids = [1, 2, 3, 4, 5]
@@ -52,9 +60,143 @@ def test_existing_task_dataset():
     dataset.update_tasks(tasks)
     assert dataset.num_left() == 0
 
+def fail_on_zero(batch_args):
+    if 0 in batch_args:
+        raise ValueError("bad mini batch")
+    return [{'return': {'id': a}, 'exception': None, 'pre_time': None, 'post_time': datetime.datetime.now()} for a in batch_args]
+
+def test_get_results_with_failing_mini_batch():
+    batch_tasks = [[DaskTask(0), DaskTask(1)], [DaskTask(2), DaskTask(3)]]
+    exception_counter = Counter()
+
+    async def run():
+        async with DaskLocalCluster(n_workers=1, processes=False, asynchronous=True) as cluster:
+            async with DaskClient(cluster, asynchronous=True) as client:
+                task_futures = client.map(fail_on_zero, [[t.args for t in b] for b in batch_tasks], pure=False)
+                batch_tasks_lookup = {f.key: (b, False) for b, f in zip(batch_tasks, task_futures)}
+                tasks_progress_bar = tqdm(total=4, disable=True)
+                batch_progress_bar = tqdm(total=4, disable=True)
+                await get_results(task_futures, batch_tasks_lookup, 10, 1, tasks_progress_bar, batch_progress_bar, exception_counter)
+                return batch_tasks_lookup
+
+    batch_tasks_lookup = asyncio.run(run())
+
+    # the failing mini batch has its exception recorded against each of its tasks, without touching the other
+    assert all(processed for _, processed in batch_tasks_lookup.values())
+    assert exception_counter.count == 2
+    for t in batch_tasks[0]:
+        assert t.result is None
+        assert len(t.exceptions) == 1
+        assert 'bad mini batch' in t.exceptions[0]['exception']
+        assert t.completed
+    for t in batch_tasks[1]:
+        assert t.exceptions == []
+        assert t.result['return'] == {'id': t.args}
+        assert t.completed
+
+async def video_page_stream(video_id):
+    page = (
+        '<html><script>{"webapp.app-context":{},"webapp.video-detail":'
+        + f'{{"statusCode":0,"itemInfo":{{"itemStruct":{{"id":"{video_id}"}}}}}}'
+        + ',"webapp.a-b":{}}</script></html>'
+    ).encode()
+    # small chunks, so the markers are split across chunks as they can be off the wire
+    for i in range(0, len(page), 7):
+        yield page[i:i + 7]
+
+def stub_video_handler(request):
+    video_id = int(request.url.path.rsplit('/', 1)[-1])
+    if video_id == 0:
+        return httpx.Response(403)
+    return httpx.Response(200, content=video_page_stream(video_id))
+
+def get_stub_client():
+    return httpx.AsyncClient(transport=httpx.MockTransport(stub_video_handler), headers=HEADERS)
+
+def test_async_get_video():
+    async def run():
+        async with get_stub_client() as client:
+            video = await async_get_video(123, client)
+            try:
+                await async_get_video(0, client)
+            except InvalidResponseException as ex:
+                error = ex
+            else:
+                error = None
+        return video, error
+
+    video, error = asyncio.run(run())
+    assert video == {'id': '123'}
+    assert 'Status code: 403' in str(error)
+
+def test_async_map():
+    potential_video_ids = [0, 1, 2, 3, 4]
+    dataset = TaskDataset()
+    dataset.add_potential_ids(potential_video_ids)
+
+    async def run():
+        async with get_stub_client() as stub_client:
+            # async_map hands each call its own pooled client, swap in the stub transport for the real one
+            async def get_video(video_id, client):
+                return await async_get_video(video_id, stub_client)
+            await async_map(get_video, dataset, num_workers=2, batch_size=2, max_task_tries=2, task_timeout=1)
+
+    asyncio.run(run())
+
+    # the dataset keeps the timings and tries of each task, the video itself is checked in test_async_get_video
+    assert dataset.num_left() == 0
+    for row in dataset.tasks.to_dicts():
+        assert row['completed']
+        if row['args'] == 0:
+            assert row['result'] is None
+            assert len(row['exceptions']) == 2
+            assert all('Status code: 403' in e['exception'] for e in row['exceptions'])
+        else:
+            assert row['result'] is not None
+            assert row['result']['post_time'] is not None
+            assert row['exceptions'] == []
+
+def echo_interface(args, network_interface):
+    return args, network_interface
+
+async def echo_video(video_id, client):
+    return {'id': video_id}
+
+def test_task_functions_pickle_by_value():
+    # run_random_sample.sh runs get_random_sample.py as __main__, so cloudpickle ships the task functions by value,
+    # along with any module level state they reference
+    multi_interface_func = MultiNetworkInterfaceFunc(echo_interface, network_interfaces=['eth0', 'wlan0'], ratios=[0.5, 0.5], task_nthreads=4)
+    async_batch_func = AsyncBatchFunc(echo_video, task_nthreads=2)
+    # pickle after the thread pools, event loop and clients have been made, as they are on the scheduler's side too
+    get_curl_client(None)
+    thread_map([1, 2], function=abs, num_workers=2)
+    assert multi_interface_func([1, 2, 3, 4]) == [(1, 'eth0'), (2, 'eth0'), (3, 'wlan0'), (4, 'wlan0')]
+    assert [r['return'] for r in async_batch_func([1, 2])] == [{'id': 1}, {'id': 2}]
+    functions = [
+        DaskFunc(get_video),
+        thread_map,
+        MultiNetworkInterfaceFunc(DaskFunc(get_video), network_interfaces=[None], ratios=[1], task_nthreads=2),
+        multi_interface_func,
+        AsyncBatchFunc(async_get_video, task_nthreads=2),
+        async_batch_func,
+    ]
+    cloudpickle.register_pickle_by_value(get_random_sample)
+    try:
+        shipped_functions = [cloudpickle.loads(cloudpickle.dumps(function)) for function in functions]
+    finally:
+        cloudpickle.unregister_pickle_by_value(get_random_sample)
+
+    # the unpickled functions start their own thread pools, event loop and clients
+    assert shipped_functions[3]([1, 2, 3, 4]) == [(1, 'eth0'), (2, 'eth0'), (3, 'wlan0'), (4, 'wlan0')]
+    assert [r['return'] for r in shipped_functions[5]([1, 2])] == [{'id': 1}, {'id': 2}]
+
 def main():
     test_existing_task_dataset()
     test_task_dataset()
+    test_get_results_with_failing_mini_batch()
+    test_async_get_video()
+    test_async_map()
+    test_task_functions_pickle_by_value()
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -24,18 +24,15 @@ async def main():
     test_video_ids = []
     test_truths = []
     score = 0
+    # a year ahead of now, shifted into the top 32 bits once rather than on every fake id
+    timestamp_1year_bits = int((datetime.datetime.now() + datetime.timedelta(days=365)).timestamp()) << 32
     for i in range(100):
         if random.random() > 0.5:
             test_video_ids.append(videos[i]['id'])
             test_truths.append(True)
         else:
-            timestamp_1year_time = int((datetime.datetime.now() + datetime.timedelta(days=365)).timestamp())
-            # convert to binary
-            timestamp_binary = format(timestamp_1year_time, '032b')
-            # create random 32 bit number
-            random_32bit = format(random.getrandbits(32), '032b')
-            # concatenate into 64 bit number
-            random_64bit = int(timestamp_binary + random_32bit, 2)
+            # random 32 bit number in the bottom bits
+            random_64bit = timestamp_1year_bits | random.getrandbits(32)
             test_video_ids.append(random_64bit)
             test_truths.append(False)
 
@@ -1,10 +1,14 @@
+import atexit
 import datetime
-import itertools
 import json
 import os
+from types import MappingProxyType
 
 import httpx
+import numpy as np
+import orjson
 import tqdm
+import urllib3
 
 class InvalidResponseException(Exception):
     pass
@@ -12,135 +16,179 @@ class InvalidResponseException(Exception):
 class NotFoundException(Exception):
     pass
 
-def get_headers():
-    headers = {
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
-        'Accept-Encoding': 'gzip, deflate, br',
-        'Accept-Language': 'en-CA',
-        'Sec-Fetch-Dest': 'document',
-        'Sec-Fetch-Mode': 'navigate',
-        'Sec-Fetch-Site': 'none',
-        'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.0 Safari/605.1.15'
-    }
-    return headers
+# static, so built once and shared read-only by every request
+HEADERS = MappingProxyType({
+    'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8',
+    'Accept-Encoding': 'gzip, deflate, br',
+    'Accept-Language': 'en-CA',
+    'Sec-Fetch-Dest': 'document',
+    'Sec-Fetch-Mode': 'navigate',
+    'Sec-Fetch-Site': 'none',
+    'User-Agent': 'Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/605.1.15 (KHTML, like Gecko) Version/17.0 Safari/605.1.15'
+})
+
+# shared by the sync fetches so connections are pooled and kept alive between videos
+http_pool = urllib3.PoolManager(num_pools=16, maxsize=64, headers=dict(HEADERS))
+# close the kept-alive connections on exit rather than leaving them to the OS
+atexit.register(http_pool.clear)
+
+# markers around the rehydration JSON in the returned HTML
+REHYDRATION_START = b'<script id="__UNIVERSAL_DATA_FOR_REHYDRATION__" type="application/json">'
+REHYDRATION_END = b'</script>'
+# markers around just the video detail object inside the rehydration JSON
+VIDEO_DETAIL_START = b'"webapp.video-detail":'
+VIDEO_DETAIL_END = b',"webapp.a-b":'
 
-def process_response(r):
-    if r.status_code != 200:
+def process_response(status_code, content):
+    # works on the raw response bytes, so the page is never decoded to str
+    if status_code != 200:
         raise InvalidResponseException(
-            r.text, f"TikTok returned a {r.status_code} status code."
+            content, f"TikTok returned a {status_code} status code."
         )
 
-    start = r.text.find('<script id="__UNIVERSAL_DATA_FOR_REHYDRATION__" type="application/json">')
+    start = content.find(REHYDRATION_START)
     if start == -1:
         raise InvalidResponseException(
-            r.text, "Could not find normal JSON section in returned HTML."
+            content, "Could not find normal JSON section in returned HTML."
         )
 
-    start += len('<script id="__UNIVERSAL_DATA_FOR_REHYDRATION__" type="application/json">')
-    end = r.text.find("</script>", start)
+    start += len(REHYDRATION_START)
+    end = content.find(REHYDRATION_END, start)
 
     if end == -1:
         raise InvalidResponseException(
-            r.text, "Could not find normal JSON section in returned HTML."
+            content, "Could not find normal JSON section in returned HTML."
         )
 
-    data = json.loads(r.text[start:end])
-    default_scope = data.get("__DEFAULT_SCOPE__", {})
-    video_detail = default_scope.get("webapp.video-detail", {})
+    # only parse the video detail object when its markers are there,
+    # rather than the whole rehydration JSON, falling back to the full parse otherwise
+    detail_start = content.find(VIDEO_DETAIL_START, start, end)
+    detail_end = -1
+    if detail_start != -1:
+        detail_start += len(VIDEO_DETAIL_START)
+        detail_end = content.find(VIDEO_DETAIL_END, detail_start, end)
+
+    # memoryview so the JSON section isn't copied out of the page before parsing
+    if detail_end != -1:
+        video_detail = orjson.loads(memoryview(content)[detail_start:detail_end])
+    else:
+        data = orjson.loads(memoryview(content)[start:end])
+        default_scope = data.get("__DEFAULT_SCOPE__", {})
+        video_detail = default_scope.get("webapp.video-detail", {})
     if video_detail.get("statusCode", 0) != 0: # assume 0 if not present
         # TODO move this further up to optimize for fast fail
         if video_detail.get("statusCode", 0) == 10204:
             return None
         else:
             raise InvalidResponseException(
-                r.text, "TikTok JSON had an unrecognised status code."
+                content, "TikTok JSON had an unrecognised status code."
             )
     video_info = video_detail.get("itemInfo", {}).get("itemStruct")
     if video_info is None:
         raise InvalidResponseException(
-            r.text, "TikTok JSON did not contain expected JSON."
+            content, "TikTok JSON did not contain expected JSON."
         )
         
     return video_info
 
+# created on first use, so it is bound to the running event loop
+async_client = None
+
+def get_async_client():
+    global async_client
+    if async_client is None:
+        async_client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=128, max_keepalive_connections=64),
+            timeout=httpx.Timeout(10.0, connect=5.0),
+            headers=HEADERS
+        )
+    return async_client
+
+async def close_async_client():
+    # call once the fetches are done, so the pooled connections are shut down cleanly
+    global async_client
+    if async_client is not None:
+        await async_client.aclose()
+        async_client = None
+
 async def async_get_video(url):
-    headers = get_headers()
+    client = get_async_client()
 
     try:
-        async with httpx.AsyncClient() as client:
-            r = await client.get(url, headers=headers)
+        r = await client.get(url)
     except Exception:
         raise InvalidResponseException(
             "TikTok returned an invalid response."
         )
     
-    return process_response(r)
+    return process_response(r.status_code, r.content)
 
 def get_video(video_id):
     url = f"https://www.tiktok.com/@therock/video/{video_id}"
-    headers = get_headers()
 
     try:
-        with httpx.Client() as client:
-            r = client.get(url, headers=headers)
+        r = http_pool.request('GET', url)
     except Exception:
         raise InvalidResponseException(
             "TikTok returned an invalid response."
         )
     
-    return process_response(r)
+    return process_response(r.status, r.data)
 
 def optimized_get_video(video_id):
     url = f"https://www.tiktok.com/@/video/{video_id}"
-    headers = get_headers()
     
     try:
-        with httpx.Client() as client:
-            with client.stream("GET", url, headers=headers) as r:
-                if r.status_code != 200:
-                    raise InvalidResponseException(
-                        r.text, f"TikTok returned a {r.status_code} status code."
-                    )
-                text = ""
-                start = -1
-                json_start = '"webapp.video-detail":'
-                # json_start = '<script id="__UNIVERSAL_DATA_FOR_REHYDRATION__" type="application/json">'
-                json_start_len = len(json_start)
-                end = -1
-                # json_end = '</script>'
-                json_end = ',"webapp.a-b":'
-
-                for text_chunk in r.iter_text():
-                    text += text_chunk
-                    if len(text) < json_start_len:
-                        continue
+        r = http_pool.request('GET', url, preload_content=False)
+        try:
+            if r.status != 200:
+                raise InvalidResponseException(
+                    r.data, f"TikTok returned a {r.status} status code."
+                )
+            text = bytearray()
+            start = -1
+            json_start = VIDEO_DETAIL_START
+            json_start_len = len(json_start)
+            end = -1
+            json_end = VIDEO_DETAIL_END
+            # where to resume searching for the end marker, so each byte is only scanned once
+            searched_up_to = 0
+
+            for text_chunk in r.stream(65536):
+                text += text_chunk
+                if start == -1:
+                    start = text.find(json_start)
                     if start == -1:
-                        start = text.find(json_start)
-                        if start != -1:
-                            text = text[start + json_start_len:]
-                            start = 0
-                    if start != -1:
-                        end = text.find(json_end)
-                        if end != -1:
-                            text = text[:end]
-                            break
-
-                if start == -1 or end == -1:
-                    raise InvalidResponseException(
-                        text, "Could not find normal JSON section in returned HTML."
-                    )
-                video_detail = json.loads(text)
-                # default_scope = data.get("__DEFAULT_SCOPE__", {})
-                # video_detail = default_scope.get("webapp.video-detail", {})
-                if video_detail.get("statusCode", 0) != 0: # assume 0 if not present
-                    # TODO move this further up to optimize for fast fail
-                    return video_detail
-                video_info = video_detail.get("itemInfo", {}).get("itemStruct")
-                if video_info is None:
-                    raise InvalidResponseException(
-                        r.text, "TikTok JSON did not contain expected JSON."
-                    )
-                return video_info
+                        # only keep enough of the tail to catch a marker split across chunks
+                        del text[:max(0, len(text) - json_start_len + 1)]
+                        continue
+                    del text[:start + json_start_len]
+                    start = 0
+                end = text.find(json_end, searched_up_to)
+                if end != -1:
+                    text = text[:end]
+                    break
+                searched_up_to = max(0, len(text) - len(json_end) + 1)
+
+            if start == -1 or end == -1:
+                raise InvalidResponseException(
+                    text, "Could not find normal JSON section in returned HTML."
+                )
+            # orjson parses the scanned bytes directly, with no decode to str first
+            video_detail = orjson.loads(text)
+            # default_scope = data.get("__DEFAULT_SCOPE__", {})
+            # video_detail = default_scope.get("webapp.video-detail", {})
+            if video_detail.get("statusCode", 0) != 0: # assume 0 if not present
+                # TODO move this further up to optimize for fast fail
+                return video_detail
+            video_info = video_detail.get("itemInfo", {}).get("itemStruct")
+            if video_info is None:
+                raise InvalidResponseException(
+                    text, "TikTok JSON did not contain expected JSON."
+                )
+            return video_info
+        finally:
+            r.release_conn()
     except Exception as ex:
         raise InvalidResponseException(
             f"TikTok returned an invalid response: {ex}"
@@ -171,8 +219,8 @@ class FuncWrapper:
 def main():
     this_dir_path = os.path.dirname(os.path.realpath(__file__))
     
-    with open(os.path.join(this_dir_path, '..', 'figs', 'all_videos', 'all_found_segments_combinations.json'), 'r') as file:
-        data = json.load(file)
+    with open(os.path.join(this_dir_path, '..', 'figs', 'all_videos', 'all_found_segments_combinations.json'), 'rb') as file:
+        data = orjson.loads(file.read())
 
     # get bits of non timestamp sections of ID
     # order dict according to interval
@@ -180,14 +228,14 @@ def main():
     data = sorted(data, key=lambda x: x[0][0])
     # get rid of millisecond bits
     data = [t for t in data if t[0] != (0,9)]
-    interval_bits = []
+    # build every combination of the non timestamp bits as integers, with the first interval the most significant,
+    # by shifting the combinations so far up past each interval and broadcasting an or with its values
+    other_ints = np.zeros(1, dtype=np.uint64)
+    other_bits_width = 0
     for interval, vals in data:
-        # format ints to binary
         num_bits = interval[1] - interval[0] + 1
-        bits = [format(i, f'0{num_bits}b') for i in vals]
-        interval_bits.append(bits)
-    other_bit_sequences = itertools.product(*interval_bits)
-    other_bit_sequences = [''.join(bits) for bits in other_bit_sequences]
+        other_ints = ((other_ints[:, None] << np.uint64(num_bits)) | np.array(vals, dtype=np.uint64)[None, :]).ravel()
+        other_bits_width += num_bits
 
     # get all videos in 1 millisecond
     num_time = 1
@@ -199,21 +247,17 @@ def main():
     time_delta = datetime.timedelta(**{unit_map[time_unit]: num_time})
     start_time = datetime.datetime(2024, 3, 1, 20, 0, 0)
     end_time = start_time + time_delta
-    start_timestamp = start_time.timestamp()
-    end_timestamp = end_time.timestamp()
-    c_time = start_timestamp
-    all_timestamp_bits = []
-    while c_time < end_timestamp:
-        unix_timestamp_bits = format(int(c_time), '032b')
-        milliseconds = int(format(c_time, '.3f').split('.')[1])
-        milliseconds_bits = format(milliseconds, '010b')
-        timestamp_bits = unix_timestamp_bits + milliseconds_bits
-        all_timestamp_bits.append(timestamp_bits)
-        c_time += 0.001
-
-    potential_video_bits = itertools.product(all_timestamp_bits, other_bit_sequences)
-    potential_video_bits = [''.join(bits) for bits in potential_video_bits]
-    potential_video_ids = [int(bits, 2) for bits in potential_video_bits]
+    # step through the window in integer epoch milliseconds,
+    # packing each as 32 bits of unix seconds followed by 10 bits of milliseconds
+    start_epoch_ms = int(start_time.timestamp()) * 1000 + start_time.microsecond // 1000
+    num_ms = -(-time_delta // datetime.timedelta(milliseconds=1))
+    epoch_ms = np.arange(start_epoch_ms, start_epoch_ms + num_ms, dtype=np.uint64)
+    timestamp_ints = ((epoch_ms // np.uint64(1000)) << np.uint64(10)) | (epoch_ms % np.uint64(1000))
+
+    # the ids are packed with broadcasting, one row per millisecond,
+    # and only turned into python ints a row at a time as they're fetched
+    potential_video_ids = (timestamp_ints[:, None] << np.uint64(other_bits_width)) | other_ints[None, :]
+    num_potential_video_ids = potential_video_ids.size
     num_workers = 1
     reqs_per_ip = -1
     task_batch_size = 1
@@ -222,37 +266,6 @@ def main():
     worker_mem = 512
     cluster_type = 'local'
     # r = await async_map(test_real_video, potential_video_ids, num_workers=64)
-    results = []
-    func = FuncWrapper(optimized_get_video)
-    for video_id in tqdm.tqdm(potential_video_ids):
-        results.append(func(video_id))
-
-    num_hits = len([r for r in results if r.result and r.result['res'] is not None])
-    num_valid = len([r for r in results if r.completed])
-    print(f"Num hits: {num_hits}, Num valid: {num_valid}, Num potential video IDs: {len(potential_video_ids)}")
-    print(f"Fraction hits: {num_hits / num_valid}")
-    print(f"Fraction valid: {num_valid / len(potential_video_ids)}")
-    # convert to jsonable format
-    json_results = [
-        {
-            'args': r.args, 
-            'exceptions': [{
-                    'exception': str(e['exception']),
-                    'pre_time': e['pre_time'].isoformat(),
-                    'post_time': e['post_time'].isoformat()
-                }
-                for e in r.exceptions
-            ], 
-            'result': {
-                'return': r.result['res'] if r.result is not None else None,
-                'pre_time': r.result['pre_time'].isoformat() if r.result is not None else None,
-                'post_time': r.result['post_time'].isoformat() if r.result is not None else None
-            },
-            'completed': r.completed
-        }
-        for r in results
-    ]
-
     results_dir_path = os.path.join(this_dir_path, '..', 'data', 'results')
     results_dirs = [dir_name for dir_name in os.listdir(results_dir_path)]
     new_result_dir = str(max([int(d) for d in results_dirs]) + 1) if results_dirs else '0'
@@ -275,8 +288,41 @@ def main():
     with open(os.path.join(this_dir_path, '..', 'data', 'results', new_result_dir, 'parameters.json'), 'w') as f:
         json.dump(params, f)
 
-    with open(os.path.join(this_dir_path, '..', 'data', 'results', new_result_dir, 'results.json'), 'w') as f:
-        json.dump(json_results, f)
+    # each result is written out as soon as it's fetched, so only the counts are kept in memory
+    # orjson writes naive datetimes in the same ISO 8601 form as isoformat(), so they are passed through as is
+    num_hits = 0
+    num_valid = 0
+    func = FuncWrapper(optimized_get_video)
+    video_ids = (video_id for row in potential_video_ids for video_id in row.tolist())
+    with open(os.path.join(this_dir_path, '..', 'data', 'results', new_result_dir, 'results.json'), 'wb', buffering=1 << 20) as f:
+        f.write(b'[')
+        for i, video_id in enumerate(tqdm.tqdm(video_ids, total=num_potential_video_ids)):
+            r = func(video_id)
+            # a call is completed if it didn't raise, and a hit if it also returned a video
+            completed = r['exception'] is None
+            num_valid += completed
+            num_hits += completed and r['res'] is not None
+            if i > 0:
+                f.write(b',')
+            f.write(orjson.dumps({
+                'args': video_id, 
+                'exceptions': [] if completed else [{
+                    'exception': str(r['exception']),
+                    'pre_time': r['pre_time'],
+                    'post_time': r['post_time']
+                }], 
+                'result': {
+                    'return': r['res'] if completed else None,
+                    'pre_time': r['pre_time'] if completed else None,
+                    'post_time': r['post_time'] if completed else None
+                },
+                'completed': completed
+            }))
+        f.write(b']')
+
+    print(f"Num hits: {num_hits}, Num valid: {num_valid}, Num potential video IDs: {num_potential_video_ids}")
+    print(f"Fraction hits: {num_hits / num_valid}")
+    print(f"Fraction valid: {num_valid / num_potential_video_ids}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -30,7 +30,7 @@ def using_threaded_curl(ids, max_workers=8):
 def use_single_curl(video_id):
     try:
         url = f"https://www.tiktok.com/@/video/{video_id}"
-        headers = get_random_sample.get_headers()
+        headers = get_random_sample.HEADERS
         
         network_interface = None
         client = get_random_sample.PyCurlClient(network_interface=network_interface)
@@ -40,9 +40,7 @@ def use_single_curl(video_id):
         if resp.status_code >= 300:
             raise get_random_sample.InvalidResponseException(f"Status code: {resp.status_code}")
 
-        resp_html = resp.text
-
-        video = get_random_sample.process_video(resp_html, headers=resp.headers)
+        video = get_random_sample.process_video(resp.content, headers=resp.headers)
     except Exception as e:
         return {'error': str(e), 'id': video_id}
     else:
@@ -63,7 +61,7 @@ def using_multi_curl(ids, max_workers=8):
     # Create a list to hold Curl objects and their buffers
     client_map = {}
     id_map = {}
-    headers = get_random_sample.get_headers()
+    headers = get_random_sample.HEADERS
 
     def add_transfer(video_id):
         url = f"https://www.tiktok.com/@/video/{video_id}"
@@ -73,9 +71,9 @@ def using_multi_curl(ids, max_workers=8):
         id_map[id(client.c)] = video_id
         multi.add_handle(client.c)
 
-    def process_video(video_id, text, headers):
+    def process_video(video_id, content, headers):
         try:
-            video = get_random_sample.process_video(text, headers)
+            video = get_random_sample.process_video(content, headers)
         except Exception as e:
             return {'error': str(e), 'id': video_id}
         else:
@@ -113,7 +111,7 @@ def using_multi_curl(ids, max_workers=8):
                 for c in ok_list:
                     resp = client_map[id(c)]._get_response()
                     video_id = id_map[id(c)]
-                    future = executor.submit(process_video, video_id, resp.text, headers=resp.headers)
+                    future = executor.submit(process_video, video_id, resp.content, headers=resp.headers)
                     futures.append(future)
                     multi.remove_handle(c)
                     curl_processed_count += 1